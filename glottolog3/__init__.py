@@ -1,14 +1,18 @@
 from functools import partial
+import threading
 
 from pyramid.httpexceptions import HTTPMovedPermanently
 from pyramid.config import Configurator
 from pyramid.response import Response
-from sqlalchemy.orm import joinedload
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from clld.interfaces import ICtxFactoryQuery, IDownload, IMapMarker, IDomainElement, IValueSet
 from clld.web.app import menu_item, CtxFactoryQuery
 from clld.web.icon import MapMarker
 from clld.web.adapters.base import adapter_factory, Index
 from clld.web.adapters.download import N3Dump, Download
+from clld.db.meta import DBSession
 from clld.db.models.common import Language, Source, ValueSet, ValueSetReference
 from clldutils import svg
 
@@ -31,29 +35,62 @@ class GlottologMapMarker(MapMarker):
         return super(GlottologMapMarker, self).__call__(ctx, req)
 
 
+_LEGACY_IDS = None
+_LEGACY_IDS_LOCK = threading.Lock()
+
+
+def legacy_ids():
+    """
+    :return: `frozenset` of the IDs of all `LegacyCode` objects, loaded once per process.
+    """
+    global _LEGACY_IDS
+    if _LEGACY_IDS is None:
+        with _LEGACY_IDS_LOCK:
+            if _LEGACY_IDS is None:
+                _LEGACY_IDS = frozenset(r[0] for r in DBSession.query(models.LegacyCode.id))
+    return _LEGACY_IDS
+
+
+def _invalidate_legacy_ids(*args):
+    global _LEGACY_IDS
+    _LEGACY_IDS = None
+
+
+for _evt in ['after_insert', 'after_update', 'after_delete']:
+    event.listen(models.LegacyCode, _evt, _invalidate_legacy_ids)
+
+
 class GLCtxFactoryQuery(CtxFactoryQuery):
     def refined_query(self, query, model, req):
         if model == Language:
+            # Collections are loaded via separate SELECTs, to avoid the row multiplication
+            # of joining several one-to-many relations at once. Languoid.children is
+            # lazy-loaded, because for leaf nodes it is set in `__call__` already.
             query = query.options(
                 joinedload(models.Languoid.family),
-                joinedload(models.Languoid.children),
-                joinedload(Language.valuesets)
-                    .joinedload(ValueSet.references)
+                selectinload(models.Languoid.macroareas),
+                selectinload(Language.valuesets)
+                    .selectinload(ValueSet.references)
                     .joinedload(ValueSetReference.source),
-                joinedload(Language.valuesets).joinedload(ValueSet.values),
-                joinedload(Language.valuesets).joinedload(ValueSet.parameter),
+                selectinload(Language.valuesets).selectinload(ValueSet.values),
+                selectinload(Language.valuesets).joinedload(ValueSet.parameter),
             )
         return query
 
     def __call__(self, model, req):
         if model == Language:
             # responses for no longer supported legacy codes
-            if not models.Languoid.get(req.matchdict['id'], default=None):
-                legacy = models.LegacyCode.get(req.matchdict['id'], default=None)
-                if legacy:
+            languoid = models.Languoid.get(req.matchdict['id'], default=None)
+            if not languoid:
+                if req.matchdict['id'] in legacy_ids():
+                    legacy = models.LegacyCode.get(req.matchdict['id'])
                     raise HTTPMovedPermanently(location=legacy.url(req))
                 # Fall through to `clld.web.app.ctx_factory` handling dealt out but no longer
                 # active glottocodes by looking up `Config`.
+            elif languoid.child_family_count == languoid.child_language_count \
+                    == languoid.child_dialect_count == 0:
+                # The denormalized counts tell us that there are no children to query for:
+                set_committed_value(languoid, 'children', [])
         elif model == Source:
             if ':' in req.matchdict['id']:
                 # We support Source URLs using the "qualified" bibtex key as ID.
@@ -66,26 +103,41 @@ class GLCtxFactoryQuery(CtxFactoryQuery):
         return super(GLCtxFactoryQuery, self).__call__(model, req)
 
 
+_ROUTE_PATTERNS = {
+    'languages': '/glottolog/language',
+    'language': '/resource/languoid/id/{id:[^/\.]+}',
+    'source': '/resource/reference/id/{id:[^/\.]+}',
+    'sources': '/langdoc',
+    #'provider': '/langdoc/langdocinformation#provider-{id}',
+    'providers': '/langdoc/langdocinformation',
+}
+
+_SITEMAPS = ('language', 'source')
+
+_ROUTES_XHTML = (
+    ('languoid.xhtml', '/resource/languoid/id/{id:[^/\.]+}.xhtml'),
+    ('reference.xhtml', '/resource/reference/id/{id:[^/\.]+}.xhtml'),
+)
+
+
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
     settings['navbar.inverse'] = True
-    settings['route_patterns'] = {
-        'languages': '/glottolog/language',
-        'language': '/resource/languoid/id/{id:[^/\.]+}',
-        'source': '/resource/reference/id/{id:[^/\.]+}',
-        'sources': '/langdoc',
-        #'provider': '/langdoc/langdocinformation#provider-{id}',
-        'providers': '/langdoc/langdocinformation',
-    }
-    settings['sitemaps'] = ['language', 'source']
+    # Connection pool configuration, unless specified in the config file:
+    settings.setdefault('sqlalchemy.pool_size', 20)
+    settings.setdefault('sqlalchemy.max_overflow', 40)
+    settings.setdefault('sqlalchemy.pool_pre_ping', True)
+    settings.setdefault('sqlalchemy.pool_recycle', 1800)
+    settings['route_patterns'] = dict(_ROUTE_PATTERNS)
+    settings['sitemaps'] = list(_SITEMAPS)
     config = Configurator(settings=settings)
     #
     # Note: The following routes must be registered before including the clld web app,
     # because they are special cases of a more general route pattern registered there.
     #
-    config.add_route('languoid.xhtml', '/resource/languoid/id/{id:[^/\.]+}.xhtml')
-    config.add_route('reference.xhtml', '/resource/reference/id/{id:[^/\.]+}.xhtml')
+    for name, pattern in _ROUTES_XHTML:
+        config.add_route(name, pattern)
 
     config.include('clldmpg')
     config.add_route_and_view(
@@ -80,8 +80,12 @@ class LanguoidCsvDump(CsvDump):
 class LanguoidN3Dump(N3Dump):
 
     def query(self, req):
-        return req.db.query(Language).options(sa.orm.joinedload_all(
-            Language.languageidentifier, LanguageIdentifier.identifier))\
+        # The dump is paged via LIMIT/OFFSET, so we load the identifiers and macroareas for
+        # each page in separate queries rather than joining them into the paged one:
+        return req.db.query(Languoid).options(
+            sa.orm.selectinload(Languoid.macroareas),
+            sa.orm.selectinload(Language.languageidentifier)
+                .joinedload(LanguageIdentifier.identifier))\
             .order_by(Language.pk)
 
 
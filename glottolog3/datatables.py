@@ -1,5 +1,5 @@
 from sqlalchemy import or_, and_, func
-from sqlalchemy.orm import aliased, joinedload, contains_eager
+from sqlalchemy.orm import aliased, joinedload, selectinload, contains_eager
 from clld.web.util.htmllib import HTML
 from clld.db.meta import DBSession
 from clld.db.util import icontains
@@ -79,8 +79,11 @@ class MacroareaCol(Col):
                    href=dt.req.route_url('home.glossary', _anchor='macroarea')))
         super(MacroareaCol, self).__init__(dt, name, **kw)
 
+    def format(self, item):
+        return item.macroareas_str
+
     def search(self, qs):
-        return Languoid.macroareas.contains(qs)
+        return Languoid.macroareas.any(name=qs)
 
 
 class IsoCol(Col):
@@ -125,6 +128,7 @@ class Families(Languages):
             .outerjoin(self.top_level_family, self.top_level_family.pk == Languoid.family_pk)\
             .options(
                 contains_eager(Languoid.family, alias=self.top_level_family),
+                selectinload(Languoid.macroareas),
             )
 
         if self.type == 'families':
@@ -140,7 +144,7 @@ class Families(Languages):
             return [
                 NameCol(self, 'name'),
                 LevelCol(self, 'level'),
-                MacroareaCol(self, 'macro-area', model_col=Languoid.macroareas),
+                MacroareaCol(self, 'macro-area'),
                 Col(self, 'child_family_count', model_col=Languoid.child_family_count, sTitle='Sub-families'),
                 Col(self, 'child_language_count', model_col=Languoid.child_language_count, sTitle='Child languages'),
                 FamilyCol(self, 'top-level family'),
@@ -150,7 +154,7 @@ class Families(Languages):
             NameCol(self, 'name'),
             FamilyCol(self, 'top-level family'),
             IsoCol(self, 'iso', sTitle='ISO-639-3'),
-            MacroareaCol(self, 'macro-area', model_col=Languoid.macroareas),
+            MacroareaCol(self, 'macro-area'),
             Col(self, 'child_dialect_count', model_col=Languoid.child_dialect_count, sTitle='Child dialects', sClass='right'),
             Col(self, 'latitude'),
             Col(self, 'longitude'),
@@ -12,23 +12,33 @@ from clld.lib.bibtex import EntryType
 from clldutils import jsonlib
 from clldutils.text import split_text
 from clldutils.apilib import assert_release
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, load_only
 
 from pyglottolog.references import BibFile
 
 from glottolog3 import models
 from glottolog3.scripts.util import (
     recreate_treeclosure, idjoin, add_parameter, split_items, add_identifiers, add_values,
+    split_strip_set,
 )
 
 
+# Names of the columns a `Ref` can be populated with from BibTeX fields:
+REF_COLUMNS = frozenset(
+    col.name for table in [common.Source.__table__, models.Ref.__table__]
+    for col in table.columns)
+
+
+# Sets of providers for which computerized assignment of languoids and doctypes is disabled:
+NO_CA = (frozenset(['degruyter']), frozenset(['benjamins']))
+
+
 def gc2version(args):
     return args.pkg_dir.parent / 'archive' / 'glottocode2version.json'
 
 
 def load(args):
     glottolog = args.repos
-    fts.index('fts_index', models.Ref.fts, DBSession.bind)
     DBSession.execute("CREATE EXTENSION IF NOT EXISTS unaccent WITH SCHEMA public;")
     version = assert_release(glottolog.repos)
     dataset = common.Dataset(
@@ -127,6 +137,7 @@ def load(args):
         data.add(
             models.Doctype, doctype.id, id=doctype.id,
             name=doctype.name,
+            display_name=models.Doctype.format_name(doctype.name),
             description=doctype.description,
             abbr=doctype.abbv,
             ord=doctype.rank)
@@ -143,12 +154,14 @@ def load(args):
     DBSession.flush()
 
     s = time()
+    pks, related = source_pks(), []
     for i, entry in enumerate(
             BibFile(glottolog.build_path('monster-utf8.bib'), api=glottolog).iterentries()):
         if i % 10000 == 0:
+            flush_refs(related)
             args.log.info('{0}: {1:.3}'.format(i, time() - s))
             s = time()
-        ref = load_ref(data, entry, lgcodes, lgsources)
+        ref = load_ref(data, entry, lgcodes, lgsources, pk=next(pks), related=related)
         if 'macro_area' in entry.fields:
             mas = []
             for ma in split_text(entry.fields['macro_area'], separators=',;', strip=True):
@@ -156,6 +169,7 @@ def load(args):
                 ma = glottolog.macroareas.get('Papunesia' if ma == 'Papua' else ma)
                 mas.append(ma.name)
             ref.macroareas = ', '.join(mas)
+    flush_refs(related)
 
 
 def prime(args):
@@ -215,8 +229,7 @@ order by
             domainelement=med_domain[idjoin('med', med[3])],
             valueset=vs,
         ))
-        DBSession.flush()
-        DBSession.add(common.ValueSetReference(source_pk=med[0], valueset_pk=vs.pk))
+        DBSession.add(common.ValueSetReference(source_pk=med[0], valueset=vs))
 
     recreate_treeclosure()
 
@@ -264,8 +277,10 @@ group by l.id, l.pk, vs.contribution_pk, vs.parameter_pk"""):
             .join(common.Language)\
             .join(common.Parameter)\
             .filter(common.Parameter.id == 'macroarea')\
-            .options(joinedload(common.ValueSet.values), joinedload(common.ValueSet.language)):
-        vs.language.macroareas = ', '.join([macroareas[v.domainelement_pk][1] for v in vs.values])
+            .options(joinedload(common.ValueSet.values)):
+        for v in vs.values:
+            DBSession.add(models.Languoidmacroarea(
+                languoid_pk=vs.language_pk, macroarea_pk=v.domainelement_pk))
 
     for row in list(DBSession.execute(
         "select pk, pages, pages_int, startpage_int from source where pages_int < 0"
@@ -274,16 +289,13 @@ group by l.id, l.pk, vs.contribution_pk, vs.parameter_pk"""):
 
     version = assert_release(args.repos.repos)
     with jsonlib.update(gc2version(args), indent=4) as legacy:
-        for lang in DBSession.query(common.Language):
+        for lang in DBSession.query(common.Language).options(load_only('id', 'jsondata')):
             if lang.id not in legacy:
                 lang.update_jsondata(new=True)
                 legacy[lang.id] = version
 
-    valuesets = {
-        r[0]: r[1] for r in DBSession.query(common.ValueSet.id, common.ValueSet.pk)}
-    refs = {
-        r[0]: r[1]
-        for r in DBSession.query(models.Refprovider.id, models.Refprovider.ref_pk)}
+    valuesets = dict(DBSession.query(common.ValueSet.id, common.ValueSet.pk))
+    refs = dict(DBSession.query(models.Refprovider.id, models.Refprovider.ref_pk))
 
     for vsid, vspk in valuesets.items():
         if vsid.startswith('macroarea-'):
@@ -378,70 +390,117 @@ def load_languoid(glottolog, data, lang, nodemap):
                     add(pid, [('1', '')], with_de=False, description=val)
 
 
-def load_ref(data, entry, lgcodes, lgsources):
-    kw = {'jsondata': {}, 'language_note': entry.fields.get('lgcode')}
-    for col in common.Source.__table__.columns:
-        if col.name in entry.fields:
-            kw[col.name] = entry.fields.get(col.name)
-    for col in models.Ref.__table__.columns:
-        if col.name in entry.fields:
-            kw[col.name] = entry.fields.get(col.name)
-    for col in entry.fields:
-        if col not in kw:
-            kw['jsondata'][col] = entry.fields[col]
+def expunge(*classes):
+    """
+    Remove all instances of `classes` from the session.
+    """
+    for obj in [obj for obj in DBSession if isinstance(obj, classes)]:
+        DBSession.expunge(obj)
+
+
+@functools.lru_cache(maxsize=None)
+def bibtex_type(type_):
+    """
+    :return: The `EntryType` for the BibTeX entry type `type_`, memoized since there are \
+    only few distinct types.
+    """
     try:
-        btype = EntryType.from_string(entry.type.lower())
+        return EntryType.from_string(type_.lower())
     except ValueError:
-        btype = EntryType.misc
+        return EntryType.misc
+
 
+def flush_refs(related):
+    """
+    Flush the pending `Ref` objects, then insert the `related` association objects.
+
+    The association objects carry only the foreign keys of their `Ref`, so the unit of work
+    cannot tell that their rows depend on the `Ref` rows; flushing in two steps guarantees
+    the insert order.
+    """
+    DBSession.flush()
+    DBSession.add_all(related)
+    DBSession.flush()
+    del related[:]
+    # Keep the identity map small, by dropping the objects we will not touch again:
+    expunge(models.Ref, models.Refprovider, models.Refdoctype, common.LanguageSource)
+
+
+def source_pks(batch_size=5000):
+    """
+    Generator of primary keys for new `Source` objects, reserved from the sequence in batches.
+
+    Assigning primary keys upfront allows adding related objects without having to flush
+    each new `Source` first.
+    """
+    while True:
+        for row in DBSession.execute(
+                "SELECT nextval('source_pk_seq') FROM generate_series(1, :n)",
+                {'n': batch_size}):
+            yield row[0]
+
+
+def load_ref(data, entry, lgcodes, lgsources, pk, related):
+    """
+    Load data from one BibTeX entry.
+
+    :param pk: Primary key for the new `Ref`, as reserved by `source_pks`.
+    :param related: `list` to which the association objects for the new `Ref` are appended \
+    - rather than adding them to the session - to be inserted via `flush_refs`.
+    :return: The new `models.Ref` instance.
+    """
+    fields = entry.fields
+    kw = {'pk': pk, 'jsondata': {}, 'language_note': fields.get('lgcode')}
+    for name, value in fields.items():
+        if name in REF_COLUMNS:
+            kw[name] = value
+        else:
+            kw['jsondata'][name] = value
+    # Computed properties of the entry, which we evaluate only once:
+    publisher_and_address, weight = entry.publisher_and_address, entry.weight
     kw.update(
-        publisher=entry.publisher_and_address[0],
-        address=entry.publisher_and_address[1],
+        publisher=publisher_and_address[0],
+        address=publisher_and_address[1],
         year_int=entry.year_int,
         pages_int=entry.pages_int,
-        med_index=-entry.weight[0],
-        med_pages=entry.weight[1],
+        med_index=-weight[0],
+        med_pages=weight[1],
         med_type=entry.med_type.id,
-        id=entry.fields['glottolog_ref_id'],
-        fts=fts.tsvector('\n'.join(v for k, v in entry.fields.items() if k != 'abstract')),
-        name='{} {}'.format(entry.fields.get('author', 'na'), entry.fields.get('year', 'nd')),
-        description=entry.fields.get('title') or entry.fields.get('booktitle'),
-        bibtex_type=btype)
+        id=fields['glottolog_ref_id'],
+        fts=fts.tsvector('\n'.join(v for k, v in fields.items() if k != 'abstract')),
+        name='{} {}'.format(fields.get('author', 'na'), fields.get('year', 'nd')),
+        description=fields.get('title') or fields.get('booktitle'),
+        bibtex_type=bibtex_type(entry.type))
     ref = models.Ref(**kw)
     DBSession.add(ref)
-    DBSession.flush()
 
-    reflangs = []
-    no_ca = [{'degruyter'}, {'benjamins'}]
+    reflangs = set()
     provs = set()
-    for key in entry.fields['srctrickle'].split(','):
-        key = key.strip()
-        if key:
-            reflangs.extend(lgsources.get(key, []))
-            prov, key = key.split('#', 1)
-            provs.add(prov)
-            DBSession.add(models.Refprovider(
-                provider_pk=data['Provider'][prov].pk,
-                ref_pk=ref.pk,
-                id='{0}:{1}'.format(prov, key)))
+    for key in split_strip_set(fields['srctrickle']):
+        reflangs.update(lgsources.get(key, []))
+        prov, key = key.split('#', 1)
+        provs.add(prov)
+        related.append(models.Refprovider(
+            provider_pk=data['Provider'][prov].pk,
+            ref_pk=ref.pk,
+            id='{0}:{1}'.format(prov, key)))
 
     langs, trigger = entry.languoids(lgcodes)
-    if trigger and ((provs in no_ca) or (reflangs)):
+    if trigger and ((provs in NO_CA) or (reflangs)):
         # Discard computerized assigned languoids for bibs where this does not make sense,
         # or for bib entries that have been manually assigned in a Languoid's ini file.
         langs, trigger = [], None
 
-    for lid in set(reflangs + langs):
-        DBSession.add(
-            common.LanguageSource(
-                language_pk=data['Languoid'][lid].pk, source_pk=ref.pk, active=not bool(trigger)))
+    for lid in reflangs.union(langs):
+        related.append(common.LanguageSource(
+            language_pk=data['Languoid'][lid].pk, source_pk=ref.pk, active=not bool(trigger)))
     if trigger:
         ref.ca_language_trigger = trigger
 
     doctypes, trigger = entry.doctypes(data['Doctype'])
-    if trigger is None or provs not in no_ca:
+    if trigger is None or provs not in NO_CA:
         for dt in set(doctypes):
-            DBSession.add(models.Refdoctype(doctype_pk=dt.pk, ref_pk=ref.pk))
+            related.append(models.Refdoctype(doctype_pk=dt.pk, ref_pk=ref.pk))
     if trigger:
         ref.ca_doctype_trigger = trigger
 
@@ -212,7 +212,7 @@ def language_query(req=None):
     if req:
         macroarea = req.params.get('macroarea')
         if macroarea:
-            query = query.filter(Languoid.macroareas.contains(macroarea))
+            query = query.filter(Languoid.macroareas.any(name=macroarea))
         families = [f for f in req.params.get('family', '').split(',') if f]
         if families:
             family = aliased(Languoid)
@@ -241,7 +241,7 @@ def family_query(req=None):
     if req:
         macroarea = req.params.get('macroarea')
         if macroarea:
-            query = query.filter(Languoid.macroareas.contains(macroarea))
+            query = query.filter(Languoid.macroareas.any(name=macroarea))
     return query
 
 
@@ -1,9 +1,11 @@
 """
 Project related model.
 """
+from collections import defaultdict
 from string import capwords
 
 from zope.interface import implementer
+from pyramid.decorator import reify
 
 from sqlalchemy import (
     Column,
@@ -12,14 +14,15 @@ from sqlalchemy import (
     Unicode,
     Integer,
     ForeignKey,
-    desc,
     UniqueConstraint,
     and_,
+    case,
     cast,
     Text,
     Index,
+    text,
 )
-from sqlalchemy.orm import relationship, backref, joinedload
+from sqlalchemy.orm import relationship, backref, joinedload, selectinload, deferred
 from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.sql.expression import func
 
@@ -27,6 +30,7 @@ from clld.interfaces import ISource, ILanguage
 from clld.db.meta import DBSession, Base, CustomModelMixin
 from clld.db.models.common import (
     Language, Source, IdNameDescriptionMixin, IdentifierType, Identifier, Parameter,
+    ValueSet, ValueSetReference, DomainElement,
 )
 from clld.util import DeclEnum
 
@@ -34,6 +38,19 @@ from glottolog3.interfaces import IProvider
 from glottolog3.config import github
 
 
+# Walk up the tree along `languoid.father_pk`, yielding ancestors ordered by distance. The
+# Glottocode is looked up in the `language` table - the base table of `Languoid` - at the end:
+ANCESTORS_SQL = text("""\
+WITH RECURSIVE anc(pk, father_pk, d) AS (
+  SELECT pk, father_pk, 0 FROM languoid WHERE pk = :pk
+UNION ALL
+  SELECT l.pk, l.father_pk, anc.d + 1 FROM languoid AS l JOIN anc ON l.pk = anc.father_pk
+)
+SELECT anc.pk, l.id
+FROM anc JOIN language AS l ON l.pk = anc.pk
+WHERE anc.d > 0 ORDER BY anc.d""")
+
+
 def get_parameter(pid):
     return DBSession.query(Parameter)\
         .filter(Parameter.id == pid)\
@@ -61,9 +78,9 @@ class Provider(Base, IdNameDescriptionMixin):
     # ... using the content of the bibfield attribute of a Ref instance.
     bibfield = Column(Unicode)
 
-    @property
+    @reify
     def github_url(self):
-        return github('references/bibtex/{0}.bib'.format(self.id))
+        return github('references/bibtex/%s.bib' % self.id)
 
 
 class Doctype(Base, IdNameDescriptionMixin):
@@ -77,8 +94,15 @@ class Doctype(Base, IdNameDescriptionMixin):
 
     ord = Column(Integer)
 
+    #: The name formatted for display, see `Doctype.format_name`.
+    display_name = Column(Unicode)
+
+    @staticmethod
+    def format_name(name):
+        return capwords(name.replace('_', ' '))
+
     def __unicode__(self):
-        return capwords(self.name.replace('_', ' '))
+        return self.display_name or self.format_name(self.name)
 
 
 class Refdoctype(Base):
@@ -89,20 +113,22 @@ class Refdoctype(Base):
 
 class Refprovider(Base):
     __table_args__ = (UniqueConstraint('ref_pk', 'provider_pk', 'id'),)
-    provider_pk = Column(Integer, ForeignKey('provider.pk'), nullable=False)
+    provider_pk = Column(Integer, ForeignKey('provider.pk'), nullable=False, index=True)
     ref_pk = Column(Integer, ForeignKey('ref.pk'), nullable=False)
     id = Column(Unicode, unique=True, nullable=False)
     provider = relationship(Provider)
 
     @classmethod
     def get_stats(cls):
-        return {
-            row[0]: row[1] for row in
-            DBSession.query(Provider.pk, func.count(cls.ref_pk).label('c'))
-                .filter(Provider.pk == cls.provider_pk)
-                .group_by(Provider.pk)
-                .order_by(desc('c'))
-                .all()}
+        return dict(
+            DBSession.query(cls.provider_pk, func.count(cls.ref_pk))
+                .group_by(cls.provider_pk))
+
+
+class Languoidmacroarea(Base):
+    __table_args__ = (UniqueConstraint('languoid_pk', 'macroarea_pk'),)
+    languoid_pk = Column(Integer, ForeignKey('languoid.pk'), nullable=False)
+    macroarea_pk = Column(Integer, ForeignKey('domainelement.pk'), nullable=False, index=True)
 
 
 #-----------------------------------------------------------------------------
@@ -114,6 +140,37 @@ class LanguoidLevel(DeclEnum):
     dialect = 'dialect', 'dialect'
 
 
+class TreeNode(object):
+    """A node of the classification tree as passed to jqTree, see `Languoid.jqtree`.
+    """
+    __slots__ = ('id', 'pk', 'iso', 'level', 'label', 'children', 'child', 'map_marker')
+
+    def __init__(self, id_, pk, iso, level, label, children=None):
+        self.id = id_
+        self.pk = pk
+        self.iso = iso
+        self.level = level
+        self.label = label
+        self.children = [] if children is None else children
+        self.child = False
+        self.map_marker = None
+
+    def __json__(self, req=None):
+        res = {
+            'id': self.id,
+            'pk': self.pk,
+            'iso': self.iso,
+            'level': self.level,
+            'label': self.label,
+            'children': self.children,
+        }
+        if self.child:
+            res['child'] = True
+        if self.map_marker:
+            res['map_marker'] = self.map_marker
+        return res
+
+
 @implementer(ILanguage)
 class Languoid(CustomModelMixin, Language):
     """
@@ -132,18 +189,26 @@ class Languoid(CustomModelMixin, Language):
     # languoid is not a H-Language.
     hid = Column(Unicode, unique=True)
 
-    father_pk = Column(Integer, ForeignKey('languoid.pk'))
-    family_pk = Column(Integer, ForeignKey('languoid.pk'))
+    father_pk = Column(Integer, ForeignKey('languoid.pk'), index=True)
+    family_pk = Column(Integer, ForeignKey('languoid.pk'), index=True)
 
     level = Column(LanguoidLevel.db_type())
     bookkeeping = Column(Boolean, default=False)
     category = Column(Unicode)
     newick = Column(Unicode)
+    #: '/'-joined Glottocodes from the top-level family down to self, i.e. the path of
+    #: the languoid's directory in the Glottolog data repository.
+    path = Column(Unicode, index=True)
 
     child_family_count = Column(Integer)
     child_language_count = Column(Integer)
     child_dialect_count = Column(Integer)
-    macroareas = Column(Unicode)
+
+    #: `DomainElement`s of the "macroarea" `Parameter`
+    macroareas = relationship(
+        DomainElement,
+        secondary=Languoidmacroarea.__table__,
+        order_by='DomainElement.name')
 
     descendants = relationship(
         'Languoid',
@@ -156,6 +221,23 @@ class Languoid(CustomModelMixin, Language):
         foreign_keys=[father_pk],
         backref=backref('father', remote_side=[pk]))
 
+    @property
+    def macroareas_str(self):
+        return ', '.join(ma.name for ma in self.macroareas)
+
+    @classmethod
+    def csv_head(cls):
+        # CSV exports keep the columns they had when `macroareas` was a string column:
+        cols = set(super(Languoid, cls).csv_head())
+        cols.discard('path')
+        cols.add('macroareas')
+        return sorted(cols)
+
+    def value_to_csv(self, attr, ctx=None, req=None):
+        if attr == 'macroareas':
+            return self.macroareas_str
+        return super(Languoid, self).value_to_csv(attr, ctx=ctx, req=req)
+
     def get_identifier_objs(self, type_):
         if getattr(type_, 'value', type_) == IdentifierType.glottolog.value:
             return [
@@ -176,25 +258,46 @@ class Languoid(CustomModelMixin, Language):
             .filter(TreeClosureTable.child_pk == self.pk)\
             .order_by(TreeClosureTable.depth)
 
+    def get_ancestor_pks(self, session=None):
+        """
+        :return: `list` of primary keys of the ancestors of self, from direct parent to \
+        top-level family.
+        """
+        session = session or DBSession
+        return [r[0] for r in session.execute(ANCESTORS_SQL, {'pk': self.pk})]
+
+    def get_ancestor_ids(self, session=None):
+        """
+        :return: `list` of Glottocodes of the ancestors of self, from direct parent to \
+        top-level family.
+
+        .. note::
+
+            Unlike `get_ancestors` this does not instantiate any `Languoid` objects.
+        """
+        session = session or DBSession
+        return [r[1] for r in session.execute(ANCESTORS_SQL, {'pk': self.pk})]
+
     @property
     def github_url(self):
-        path = [self.id]
-        for l in self.get_ancestors():
-            path.append(l.id)
-        return github('languoids/tree/{0}/md.ini'.format('/'.join(reversed(path))))
+        path = self.path
+        if not path:
+            path = '/'.join(reversed([self.id] + self.get_ancestor_ids()))
+        return github('languoids/tree/{0}/md.ini'.format(path))
 
     def __json__(self, req=None, core=False):
-        def ancestor(l):
-            r = {"name": l.name, "id": l.id}
+        def ancestor(id_, name):
+            r = {"name": name, "id": id_}
             if req:
-                r['url'] = req.resource_url(l)
+                r['url'] = req.route_url('language', id=id_)
             return r
         res = super(Languoid, self).__json__(req)
         if not core:
-            res['classification'] = [ancestor(l) for l in reversed(list(self.get_ancestors()))]
+            ancestors = self.get_ancestors().with_entities(Languoid.id, Languoid.name).all()
+            res['classification'] = [ancestor(*l) for l in reversed(ancestors)]
             if self.iso_code:
                 res[IdentifierType.iso.value] = self.iso_code
-            res['macroareas'] = {}#{ma.id: ma.name for ma in self.macroareas}
+            res['macroareas'] = {ma.id: ma.name for ma in self.macroareas}
         return res
 
     def get_geocoords(self):
@@ -208,20 +311,20 @@ class Languoid(CustomModelMixin, Language):
             This method does not return the geo coordinates of the Languoid self, but of
             its descendants.
         """
-        
-        child_pks = DBSession.query(Languoid.pk)\
-            .filter(Languoid.father_pk == self.pk).subquery()
+        children = Languoid.__table__.alias('children')
         return DBSession.query(
             TreeClosureTable.parent_pk,
             Language.name,
             Language.longitude,
             Language.latitude,
             Language.id)\
-            .filter(Language.pk == TreeClosureTable.child_pk)\
-            .filter(TreeClosureTable.parent_pk.in_(child_pks))\
+            .select_from(TreeClosureTable)\
+            .join(children, children.c.pk == TreeClosureTable.parent_pk)\
+            .join(Language, Language.pk == TreeClosureTable.child_pk)\
+            .filter(children.c.father_pk == self.pk)\
             .filter(Language.latitude != None)
 
-    @property
+    @reify
     def valueset_dict(self):
         return {vs.parameter.id: vs for vs in self.valuesets}
 
@@ -252,7 +355,7 @@ class Languoid(CustomModelMixin, Language):
         return sorted(
             self._crefs('fc') + self.screfs, key=lambda r: -(r.source.year_int or 0))
 
-    @property
+    @reify
     def screfs(self):
         """
         The subclassification justification have a hereditary semantics. I.e.,
@@ -263,9 +366,21 @@ class Languoid(CustomModelMixin, Language):
         explicit justification, then one should get the parent justification.
         """
         res = self._crefs('sc')
-        if not res:
-            if self.father:
-                res = self.father.screfs
+        if not res and self.father_pk:
+            # Look up the nearest ancestor with a justified subclassification:
+            vs = DBSession.query(ValueSet)\
+                .join(TreeClosureTable, and_(
+                    TreeClosureTable.parent_pk == ValueSet.language_pk,
+                    TreeClosureTable.depth > 0))\
+                .join(Parameter, Parameter.pk == ValueSet.parameter_pk)\
+                .filter(TreeClosureTable.child_pk == self.pk)\
+                .filter(Parameter.id == 'sc')\
+                .filter(ValueSet.references.any())\
+                .order_by(TreeClosureTable.depth)\
+                .options(selectinload(ValueSet.references).joinedload(ValueSetReference.source))\
+                .first()
+            if vs:
+                res = list(vs.references)
         return res
 
     def __rdf__(self, request):
@@ -278,63 +393,76 @@ class Languoid(CustomModelMixin, Language):
             gold_type = 'Dialect'
         if gold_type:
             yield 'rdf:type', 'http://purl.org/linguistics/gold/' + gold_type
+        # Related languoids are linked via the route directly, which is cheaper than
+        # `resource_url`:
+        def url(l):
+            return request.route_url('language', id=l.id)
         if self.family:
-            yield 'skos:broaderTransitive', request.resource_url(self.family)
+            yield 'skos:broaderTransitive', url(self.family)
         if self.father:
-            yield 'skos:broader', request.resource_url(self.father)
+            yield 'skos:broader', url(self.father)
         for child in self.children:
-            yield 'skos:narrower', request.resource_url(child)
+            yield 'skos:narrower', url(child)
         if not self.active:
             yield 'skos:changeNote', 'obsolete'
-        for area in (self.macroareas or '').split(', '):
-            yield 'dcterms:spatial', area
+        for area in self.macroareas:
+            yield 'dcterms:spatial', area.name
 
     def jqtree(self, icon_map=None):
+        """
+        :return: `list` of top-level `TreeNode`s, serializable via their `__json__` method.
+        """
         tree_ = []
-        children_map = {}
-        children_of_self = [c.pk for c in self.children]
+        children_map = defaultdict(list)
+        children_of_self = frozenset(c.pk for c in self.children)
 
+        label = case(
+            [(Languoid.child_language_count > 0,
+              Languoid.name + ' (' + cast(Languoid.child_language_count, Text) + ')')],
+            else_=Languoid.name)
         query = DBSession.query(
             Languoid.father_pk,
-            Languoid.pk, Languoid.id, Languoid.name,
+            Languoid.pk, Languoid.id, label,
             Languoid.latitude, Languoid.hid,
             cast(Languoid.level, Text),
-            Languoid.child_language_count, TreeClosureTable.depth)\
+            TreeClosureTable.depth)\
         .select_from(Languoid).join(TreeClosureTable,
             Languoid.pk == TreeClosureTable.child_pk)\
         .filter(TreeClosureTable.parent_pk == (self.family_pk or self.pk))\
-        .order_by(TreeClosureTable.depth, Languoid.name)
+        .order_by(TreeClosureTable.depth, Languoid.name)\
+        .yield_per(500)
 
         for row in query:
-            fpk, cpk, id_, name, lat, hid, level, clc, depth = row
+            fpk, cpk, id_, label, lat, hid, level, depth = row
             if hid and len(hid) != 3:
                 hid = None
 
-            label = name
-            if clc:
-                label += ' (%s)' % clc
             #label = '%s [%s]' % (name, id_)
             #if level == 'language' and hid and len(hid) == 3:
             #    label += '[%s]' % hid
-            node = {'id': id_, 'pk': cpk, 'iso': hid, 'level': level, 'label': label, 'children': []}
+            node = TreeNode(id_, cpk, hid, level, label, children_map[cpk])
             if icon_map and id_ == self.id and lat:
-                node['map_marker'] = icon_map[cpk]
+                node.map_marker = icon_map[cpk]
             if cpk in children_of_self:
-                node['child'] = True
+                node.child = True
                 if icon_map and (level == 'family' or lat):
-                    node['map_marker'] = icon_map[cpk]
-            children_map[cpk] = node['children']
+                    node.map_marker = icon_map[cpk]
 
             if not fpk:
                 tree_.append(node)
             else:
-                if fpk not in children_map:
-                    # this can be the case for dialects attached to inactive nodes
-                    continue
+                # Note: Since rows are ordered by depth, a parent's node is created before
+                # its children are appended. Children of nodes missing from the query - e.g.
+                # dialects attached to inactive nodes - end up in lists no node refers to.
                 children_map[fpk].append(node)
         return tree_
 
 
+# index Languoid.get_geocoords
+language_coords_index = Index('language_has_coords',
+    Language.pk, postgresql_where=Language.latitude != None)
+
+
 # index datatables.Refs.default_order
 source_order_index = Index('source_updated_desc_pk_desc_key',
     Source.updated.desc(), Source.pk.desc(), unique=True)
@@ -349,7 +477,9 @@ class Ref(CustomModelMixin, Source):
     title -> description
     """
     pk = Column(Integer, ForeignKey('source.pk'), primary_key=True)
-    fts = Column(TSVECTOR)
+    # The full-text search vector is only used in SQL filters - and excluded from CSV
+    # exports - so it's loaded only on access:
+    fts = deferred(Column(TSVECTOR))
 
     field_labels = [
         ('author', 'author'),
@@ -441,6 +571,9 @@ class Ref(CustomModelMixin, Source):
 
 Refprovider.ref = relationship(Ref)
 
+# index datatables.FtsCol.search
+ref_fts_index = Index('fts_index', Ref.fts, postgresql_using='gin')
+
 
 class TreeClosureTable(Base):
     __table_args__ = (UniqueConstraint('parent_pk', 'child_pk'),)
@@ -1,3 +1,5 @@
+import re
+
 from clld.db.meta import DBSession
 from clld.db.models import common
 from clldutils import misc
@@ -5,6 +7,9 @@ from clldutils.text import split_text
 
 from glottolog3.models import TreeClosureTable
 
+# An item in a comma-separated list, without surrounding whitespace:
+ITEM_PATTERN = re.compile(r'[^,\s](?:[^,]*[^,\s])?')
+
 
 def split_items(s):  # pragma: no cover
     if not s:
@@ -19,6 +24,13 @@ def split_items(s):  # pragma: no cover
     return set(r)
 
 
+def split_strip_set(s):
+    """
+    :return: `set` of the non-empty, stripped items of the comma-separated string `s`.
+    """
+    return set(ITEM_PATTERN.findall(s))
+
+
 def add_identifiers(data, dblang, items, name_type=False):
     for prov, names in items.items():
         if not isinstance(names, (list, tuple)):
@@ -99,6 +111,7 @@ def recreate_treeclosure(session=None):
     - child_family_count
     - child_language_count
     - child_dialect_count
+    - path
     """
     if session is None:
         session = DBSession
@@ -146,7 +159,13 @@ def recreate_treeclosure(session=None):
     WHERE l.pk = u.pk AND (
       COALESCE(l.child_family_count, -1) != u.child_family_count OR
       COALESCE(l.child_language_count, -1) != u.child_language_count OR
-      COALESCE(l.child_dialect_count, -1) != u.child_dialect_count)"""]
+      COALESCE(l.child_dialect_count, -1) != u.child_dialect_count)""",
+    """UPDATE languoid AS l SET path = u.path
+    FROM (SELECT t.child_pk, string_agg(p.id, '/' ORDER BY t.depth DESC) AS path
+      FROM treeclosuretable AS t
+      JOIN language AS p ON p.pk = t.parent_pk
+      GROUP BY t.child_pk) AS u
+    WHERE l.pk = u.child_pk AND l.path IS DISTINCT FROM u.path"""]
     for s in sql:
         session.execute(s)
     session.execute('COMMIT')
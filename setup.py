@@ -25,6 +25,7 @@ setup(
         'markdown',
         'newick>=0.4',
         'pyglottolog~=2.0',
+        'SQLAlchemy>=1.2',
     ],
     extras_require={
         'dev': [
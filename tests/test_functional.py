@@ -88,6 +88,43 @@ def test_body(app):
     assert '[atha1245]' in str(app.get('/resource/languoid/id/chil1280.newick.txt').body)
 
 
+def test_classification(app):
+    from glottolog3.models import Languoid
+
+    app.get_json('/resource/languoid/id/stan1295.json')
+    ancestors = reversed(list(Languoid.get('stan1295').get_ancestors()))
+    assert [(c['id'], c['name']) for c in app.parsed_body['classification']] == \
+        [(a.id, a.name) for a in ancestors]
+
+
+@pytest.mark.parametrize('type_, col', [('languages', 4), ('families', 2)])
+def test_macroarea_search(app, type_, col):
+    app.get_dt('/glottolog/language?type={0}&sSearch_{1}=Eurasia'.format(type_, col))
+    rows = app.parsed_body['aaData']
+    assert rows and all('Eurasia' in row[col] for row in rows)
+
+
+def test_languages_csv(app):
+    header = app.get('/glottolog/language.csv').text.splitlines()[0].split(',')
+    assert 'macroareas' in header
+    assert 'path' not in header
+
+
+def test_macroareas(app):
+    app.get_json('/resource/languoid/id/stan1295.json')
+    assert 'Eurasia' in app.parsed_body['macroareas'].values()
+
+
+def test_ancestor_ids(app):
+    from glottolog3.models import Languoid
+
+    lang = Languoid.get('stan1295')
+    ancestors = list(lang.get_ancestors())
+    assert ancestors
+    assert lang.get_ancestor_ids() == [a.id for a in ancestors]
+    assert lang.get_ancestor_pks() == [a.pk for a in ancestors]
+
+
 def test_name_characters(app):
     assert 'at least two characters' not in app.get_xml('/resource/languoid/id/stan1295.rdf')
 
@@ -101,6 +138,61 @@ def test_parsed_body(app, xpath):
     assert len(app.parsed_body.findall(xpath)) == 1
 
 
+def test_rdf_links(app):
+    from glottolog3.models import Languoid
+
+    app.get_xml('/resource/languoid/id/stan1295.rdf')
+    broader = app.parsed_body.find('.//{http://www.w3.org/2004/02/skos/core#}broader')
+    assert broader.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource').endswith(
+        '/resource/languoid/id/' + Languoid.get('stan1295').father.id)
+
+
+def _narrower(app, id_):
+    app.get_xml('/resource/languoid/id/{0}.rdf'.format(id_))
+    return sorted(
+        e.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource').split('/')[-1]
+        for e in app.parsed_body.findall('.//{http://www.w3.org/2004/02/skos/core#}narrower'))
+
+
+def test_leaf_languoid(app):
+    from clld.db.meta import DBSession
+    from glottolog3.models import Languoid, LanguoidLevel
+
+    # Requests close the session, so we only keep the Glottocode:
+    leaf, = DBSession.query(Languoid.id)\
+        .filter(Languoid.level == LanguoidLevel.dialect)\
+        .filter(Languoid.active == True)\
+        .filter(Languoid.child_dialect_count == 0)\
+        .order_by(Languoid.pk)\
+        .first()
+    res = app.get_html('/resource/languoid/id/' + leaf)
+    assert '"child": true' not in res
+    assert _narrower(app, leaf) == []
+
+
+def test_family_languoid(app):
+    from glottolog3.models import Languoid
+
+    res = app.get_html('/resource/languoid/id/atha1245')
+    assert '"child": true' in res
+    assert _narrower(app, 'atha1245') == sorted(c.id for c in Languoid.get('atha1245').children)
+
+
+@pytest.mark.parametrize('id_', ['stan1295', 'atha1245'])
+def test_languoid_valuesets(app, id_):
+    from glottolog3.models import Languoid
+
+    res = app.get_html('/resource/languoid/id/' + id_)
+    valuesets = Languoid.get(id_).valueset_dict
+    if 'aes' in valuesets:
+        assert valuesets['aes'].values[0].name in res
+        for ref in valuesets['aes'].references:
+            if ref.source:
+                assert '/resource/reference/id/{0}'.format(ref.source.id) in res
+    for country in getattr(valuesets.get('country'), 'values', []):
+        assert '[{0}]'.format(country.domainelement.name) in res
+
+
 @pytest.mark.parametrize('feed', [
     '/langdoc.atom?cq=1&doctypes=grammar&year=',
     '/glottolog/language.atom?type=languages',
@@ -3,6 +3,7 @@ import colander
 
 from glottolog3.models import Doctype
 from glottolog3.util import normalize_language_explanation, ModelInstance
+from glottolog3.scripts.util import split_strip_set
 
 
 def test_normalize_language_explanation():
@@ -34,3 +35,14 @@ def test_ModelInstance():
     assert isinstance(mi.deserialize(None, 'existing'), Model)
     with pytest.raises(colander.Invalid):
         mi.deserialize(None, 'missing')
+
+
+@pytest.mark.parametrize('s, items', [
+    ('', set()),
+    (' ,  , ', set()),
+    ('a,,b,', {'a', 'b'}),
+    (' a b ,c\td ', {'a b', 'c\td'}),
+    ('hh:x#1, hh:x#1,hh:y#2', {'hh:x#1', 'hh:y#2'}),
+])
+def test_split_strip_set(s, items):
+    assert split_strip_set(s) == items